@@ -14,5 +14,7 @@ class ConfigV1:
         self.country = data.get("country")
         self.lang = data.get("lang")
         self.log_path = data["log_path"] if data.get("log_path") else None
+        self.change_feed = data["change_feed"] if data.get("change_feed") else False
+        self.row_hash = data["row_hash"] if data.get("row_hash") else False
 
 
@@ -14,7 +14,7 @@ from config import Configuration
 from config import ConfigV1
 from utils import Schema, parse_schema_resources
 import json
-from utils import Database
+from utils import Sink, create_sink
 
 # Basic stdout logger config
 handler = logging.StreamHandler(sys.stdout)
@@ -53,7 +53,7 @@ class ApiReaderSync:
     We suggest a concurrent flow.
     """
 
-    def __init__(self, config: ConfigV1, db: Database):
+    def __init__(self, config: ConfigV1, db: Sink):
         self.config = config
         self.db = db
         self.token: str = ""
@@ -223,6 +223,7 @@ class ApiReaderSync:
                         logger.error(f"fetching {resource_name} failed with status_code {req.status_code}")
                         return
                     item_counter = 0
+                    skipped_counter = 0
                     counter = 0
                     runs = 0
                     buffer = []
@@ -234,15 +235,15 @@ class ApiReaderSync:
                         if len(buffer) == 5000:
                             runs += 1
                             # potentially dangerous. I don't know if queue.put creates a data copy or not
-                            self.db.upsert(resource=resource_name, data=[x for x in buffer])
+                            skipped_counter += self.db.upsert(resource=resource_name, data=[x for x in buffer])
                             logger.debug(f"[{item_counter}] successfully upserted")
                             buffer = []
                             counter = 0
                     # send rest of the buffer again
                     if len(buffer) > 0:
-                        self.db.insert(resource=resource_name, data=[x for x in buffer])
+                        skipped_counter += self.db.upsert(resource=resource_name, data=[x for x in buffer])
 
-            logger.info(f"{item_counter} upserted items")
+            logger.info(f"{item_counter} upserted items, {skipped_counter} unchanged items skipped")
 
             return None
         except Exception as e:
@@ -285,7 +286,7 @@ class ApiReaderSync:
                             counter = 0
                     # send rest of the buffer again
                     if len(buffer) > 0:
-                        self.db.insert(resource=resource_name, data=[x for x in buffer])
+                        self.db.delete(resource=resource_name, data=[x for x in buffer])
             logger.info(f"{item_counter} deleted items")
 
             return None
@@ -323,7 +324,7 @@ class ApiReaderSync:
 
 if __name__ == '__main__':
 
-    with Database(Configuration, logger) as db:
+    with create_sink(Configuration, logger) as db:
 
         api_reader = ApiReaderSync(Configuration, db)
 
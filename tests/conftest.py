@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the client are imported from the repository root, like main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
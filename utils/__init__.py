@@ -1,2 +1,2 @@
 from .schema import Schema, Resource, Attribute, create_resource_column_type_map, parse_schema_resources
-from .db import Database
+from .sink import Sink, create_sink
@@ -0,0 +1,384 @@
+"""
+Columnar sinks. Decoded batches are buffered as arrow record batches per resource and written to a DuckDB
+database or to parquet files once enough rows are collected, so analytics can read the synced data directly.
+
+pyarrow (and duckdb for DuckDbSink) are optional dependencies and only required if db_type selects them.
+"""
+import json
+import logging
+import os
+import uuid
+from abc import abstractmethod
+
+from utils import Schema, Resource, Sink
+from config import ConfigV1
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+def _arrow_type(type_name: str):
+    """maps the api type names to arrow types, uuids and json are kept as strings"""
+    return {"int64": pa.int64(),
+            "int16": pa.int32(),
+            "int32": pa.int32(),
+            "database.nullint16": pa.int32(),
+            "int": pa.int32(),
+            "string": pa.string(),
+            "float64": pa.float64(),
+            "float32": pa.float32(),
+            "uuid": pa.string(),
+            "time": pa.timestamp("us"),
+            "datetime": pa.timestamp("us"),
+            "date": pa.date32(),
+            "[]string": pa.list_(pa.string()),
+            "bytes": pa.binary(),
+            "bool": pa.bool_(),
+            "json": pa.string()
+            }[type_name.lower()]
+
+
+class ColumnarSink(Sink):
+    """
+    buffers the batches of a resource as arrow record batches and hands them to _flush once flush_rows are
+    collected or the operation changes. the operations of a resource are therefore applied in the order they
+    were received, which keeps the created -> updated -> deleted sequence of a delta load intact.
+
+    batches that cannot be converted are logged and dropped on insert, upsert and delete. if a flush fails,
+    the buffered batches are written one by one, so only the batches that fail on their own are dropped.
+    """
+    flush_rows = 100_000
+
+    def __init__(self, config: ConfigV1, logger: logging.Logger):
+        if pa is None:
+            raise ImportError(f"db_type {config.db_type} requires pyarrow: pip install pyarrow")
+        super().__init__(config, logger)
+        # resource -> [operation, record batches, number of rows]
+        self.buffers: dict[str, list] = {}
+        self.arrow_schemas: dict[str, pa.Schema] = {}
+        if config.change_feed or config.row_hash:
+            logger.warning(f"change_feed and row_hash are only supported for postgres, ignored for {config.db_type}")
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # batches that were handed over are applied like on postgres, where every batch is committed
+        for resource in list(self.buffers.keys()):
+            self.flush(resource)
+        return None
+
+    def insert(self, resource, data: list[dict]):
+        """buffer new data"""
+        try:
+            batch = self._to_record_batch(resource, data)
+        except Exception as e:
+            self.logger.error(f"inserting into {resource}: with failed: {e}")
+            return
+        self._buffer(resource, "created", batch)
+
+    def upsert(self, resource, data: list[dict]) -> int:
+        """buffer updated data, the merge with the stored items is done on flush"""
+        try:
+            batch = self._to_record_batch(resource, data)
+        except Exception as e:
+            self.logger.error(f"upserting {resource}: with failed: {e}")
+            return 0
+        self._buffer(resource, "updated", batch)
+        return 0
+
+    def delete(self, resource, data: list[dict]):
+        """buffer the ids of deleted items"""
+        try:
+            id_type = self._arrow_schema(resource).field("id").type
+            batch = pa.record_batch([pa.array([x["id"] for x in data], type=id_type)], names=["id"])
+        except Exception as e:
+            self.logger.error(f"deleting {resource}: with failed: {e}")
+            return
+        self._buffer(resource, "deleted", batch)
+
+    def flush(self, resource):
+        """writes the buffered batches of the resource"""
+        if resource not in self.buffers:
+            return
+        operation, batches, rows = self.buffers.pop(resource)
+        try:
+            self._flush(resource, operation, self._last_occurrences(pa.Table.from_batches(batches)))
+            return
+        except Exception as e:
+            self.logger.warning(f"writing {rows} {operation} items of {resource} failed: {e}, "
+                                f"retrying the {len(batches)} buffered batches one by one")
+
+        for batch in batches:
+            try:
+                self._flush(resource, operation, self._last_occurrences(pa.Table.from_batches([batch])))
+            except Exception as e:
+                self.logger.error(f"writing {batch.num_rows} {operation} items of {resource}: with failed: {e}")
+
+    @abstractmethod
+    def _flush(self, resource, operation: str, table):
+        """
+        writes a table of buffered rows (created, updated) or ids (deleted) to the store.
+        raises if the table could not be written, so flush can retry the batches it consists of
+        """
+
+    def _buffer(self, resource, operation: str, batch):
+        buffered = self.buffers.get(resource)
+        if buffered is not None and buffered[0] != operation:
+            self.flush(resource)
+            buffered = None
+        if buffered is None:
+            buffered = [operation, [], 0]
+            self.buffers[resource] = buffered
+        buffered[1].append(batch)
+        buffered[2] += batch.num_rows
+        if buffered[2] >= self.flush_rows:
+            self.flush(resource)
+
+    @staticmethod
+    def _last_occurrences(table):
+        """
+        keeps only the last row of every id. the buffer joins several batches and an item can be updated more
+        than once in between, postgres applies those rows in order so the last one wins
+        """
+        if pc.count_distinct(table["id"]).as_py() == table.num_rows:
+            return table
+        positions = pa.table({"id": table["id"], "position": pa.array(range(table.num_rows), pa.int64())})
+        last = positions.group_by("id").aggregate([("position", "max")])["position_max"]
+        return table.take(pc.take(last, pc.sort_indices(last)))
+
+    def _to_record_batch(self, resource, data: list[dict]):
+        self.type_converter(resource, data)
+        col_types_dict = self.schema.lookup[resource]
+        json_columns = [k for k, v in col_types_dict.items() if v.lower() == "json"]
+        for row in data:
+            for k in json_columns:
+                if row.get(k) is not None and not isinstance(row[k], str):
+                    row[k] = json.dumps(row[k])
+        return pa.RecordBatch.from_pylist(data, schema=self._arrow_schema(resource))
+
+    def _arrow_schema(self, resource):
+        if resource not in self.arrow_schemas:
+            r: Resource = self._get_resource_by_name(resource)
+            self.arrow_schemas[resource] = pa.schema([pa.field(attr.name, _arrow_type(attr.type))
+                                                      for attr in r.attributes])
+        return self.arrow_schemas[resource]
+
+
+class DuckDbSink(ColumnarSink):
+    """
+    writes the resources to tables of a DuckDB database file. connection_string is the path of the file
+    """
+    type_map = {**Sink.type_map,
+                "float64": "DOUBLE",
+                "[]string": "VARCHAR[]",
+                "bytes": "BLOB"
+                }
+
+    def __init__(self, config: ConfigV1, logger: logging.Logger):
+        if duckdb is None:
+            raise ImportError("db_type duckdb requires duckdb: pip install duckdb")
+        super().__init__(config, logger)
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = duckdb.connect(self.config.connection_string)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super().__exit__(exc_type, exc_val, exc_tb)
+        if self.conn and self.conn is not None:
+            self.conn.close()
+
+    def create_tables(self, schema: Schema):
+        try:
+            for resource in schema.resources:
+                columns = []
+                for attr in resource.attributes:
+                    column = attr.name + " " + self.type_map[attr.type.lower()]
+                    if attr.primary_key is True:
+                        column += " PRIMARY KEY"
+                    columns.append(column)
+                self.conn.execute(f"CREATE TABLE IF NOT EXISTS {resource.name}({', '.join(columns)});")
+        except Exception as e:
+            self.logger.error(f"Error creating tables with: {e}")
+            raise e
+
+        return None
+
+    def latest_state(self, resource):
+        self.flush(resource)
+        response = self.conn.execute(f"SELECT MAX(GREATEST(created_at, updated_at)) FROM {resource}").fetchone()
+        if response is None:
+            return None
+        return response[0]
+
+    def total_client_items(self, resource):
+        self.flush(resource)
+        response = self.conn.execute(f"SELECT COUNT(*) FROM {resource}").fetchone()
+        if response is None:
+            return None
+        return response[0]
+
+    def _flush(self, resource, operation: str, table):
+        """applies the buffered batches in a single transaction, the merge of updates is done by duckdb"""
+        columns = ", ".join(table.column_names)
+        id_type = self.type_map[self.schema.lookup[resource]["id"].lower()]
+        if operation == "created":
+            stmt = f"INSERT INTO {resource} ({columns}) SELECT {columns} FROM batch"
+        elif operation == "updated":
+            stmt = f"INSERT OR REPLACE INTO {resource} ({columns}) SELECT {columns} FROM batch"
+        else:
+            stmt = f"DELETE FROM {resource} WHERE id IN (SELECT CAST(id AS {id_type}) FROM batch)"
+
+        try:
+            self.conn.begin()
+            self.conn.register("batch", table)
+            self.conn.execute(stmt)
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            raise e
+        finally:
+            self.conn.unregister("batch")
+
+
+class ParquetSink(ColumnarSink):
+    """
+    writes every resource to a directory of parquet part files below connection_string.
+    a flush of created or updated items adds a new part file and removes their ids from the other parts, so an
+    item that is created again replaces the stored one instead of being duplicated. only the part files holding
+    the affected ids are rewritten and the parts below flush_rows rows are merged on the way, so the number of
+    part files stays bounded.
+    """
+
+    def __enter__(self):
+        os.makedirs(self.config.connection_string, exist_ok=True)
+        return self
+
+    def create_tables(self, schema: Schema):
+        for resource in schema.resources:
+            os.makedirs(self._resource_path(resource.name), exist_ok=True)
+        return None
+
+    def latest_state(self, resource):
+        self.flush(resource)
+        values = [self._latest_change(path) for path in self._part_files(resource)]
+        values = [v for v in values if v is not None]
+        return max(values) if values else None
+
+    def total_client_items(self, resource):
+        self.flush(resource)
+        return sum(pq.ParquetFile(path).metadata.num_rows for path in self._part_files(resource))
+
+    def _flush(self, resource, operation: str, table):
+        new_part = None
+        if operation in ("created", "updated"):
+            new_part = self._new_part_path(resource)
+            try:
+                pq.write_table(table, new_part)
+            except Exception as e:
+                if os.path.exists(new_part):
+                    os.remove(new_part)
+                raise e
+        # the new part is written first: an interruption leaves duplicates behind instead of losing items.
+        # a retry of the batch removes them again, as its ids are removed from every other part
+        self._rewrite_parts(resource, table["id"], skip=new_part)
+
+    def _rewrite_parts(self, resource, ids, skip=None):
+        """
+        rewrites the part files that contain any of the ids without them and merges them with the part files
+        below flush_rows rows. skip is the part that was just written for the ids, it is only merged
+        """
+        value_set = ids.combine_chunks()
+        id_range = pc.min_max(value_set).as_py()
+        replaced = []
+        pending = []
+        removed = False
+        for path in self._part_files(resource):
+            metadata = pq.ParquetFile(path).metadata
+            mask = None
+            hit = False
+            if path != skip and self._may_contain(metadata, id_range["min"], id_range["max"]):
+                mask = pc.is_in(pq.read_table(path, columns=["id"])["id"], value_set=value_set)
+                hit = pc.any(mask).as_py()
+            if not hit and metadata.num_rows >= self.flush_rows:
+                continue
+            table = pq.read_table(path)
+            pending.append(table.filter(pc.invert(mask)) if hit else table)
+            replaced.append(path)
+            removed = removed or hit
+        if not removed and len(replaced) < 2:
+            return
+
+        # the merged parts are written before the replaced ones are removed, like the new part in _flush
+        written = []
+        try:
+            merged = pa.concat_tables(pending)
+            pending = None
+            for offset in range(0, merged.num_rows, self.flush_rows):
+                written.append(self._new_part_path(resource))
+                pq.write_table(merged.slice(offset, self.flush_rows), written[-1])
+        except Exception as e:
+            for path in written:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise e
+        for path in replaced:
+            os.remove(path)
+
+    @staticmethod
+    def _may_contain(metadata, low, high):
+        """false if the id statistics of a part file rule out every id between low and high"""
+        if low is None:
+            return False
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if column.path_in_schema != "id":
+                    continue
+                statistics = column.statistics
+                if statistics is None or not statistics.has_min_max:
+                    return True
+                if statistics.min <= high and statistics.max >= low:
+                    return True
+        return False
+
+    def _latest_change(self, path):
+        """latest created_at or updated_at of a part file, taken from the row group statistics where available"""
+        metadata = pq.ParquetFile(path).metadata
+        values = []
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if column.path_in_schema not in ("created_at", "updated_at"):
+                    continue
+                statistics = column.statistics
+                if statistics is not None and statistics.has_min_max:
+                    values.append(statistics.max)
+                elif statistics is None or statistics.null_count != row_group.num_rows:
+                    table = pq.read_table(path, columns=["created_at", "updated_at"])
+                    values = [pc.max(table[c]).as_py() for c in table.column_names]
+                    values = [v for v in values if v is not None]
+                    return max(values) if values else None
+        return max(values) if values else None
+
+    def _new_part_path(self, resource):
+        return os.path.join(self._resource_path(resource), f"part-{uuid.uuid4().hex}.parquet")
+
+    def _part_files(self, resource) -> list[str]:
+        path = self._resource_path(resource)
+        if not os.path.isdir(path):
+            return []
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".parquet"))
+
+    def _resource_path(self, resource):
+        return os.path.join(self.config.connection_string, resource)
@@ -1,38 +1,20 @@
+import hashlib
+import json
 import logging
 
 import psycopg2 as pg
-from datetime import datetime
-from utils import Schema, Attribute
+from utils import Schema, Resource, Attribute, Sink
 import time
 from config import ConfigV1
 
 
-class Database:
-    type_map = {"int64": "BIGINT",
-                "int16": "INT",
-                "int32": "INT",
-                "database.nullint16": "INT",
-                "int": "INT",
-                "string": "VARCHAR",
-                "float64": "REAL",
-                "float32": "REAL",
-                "uuid": "UUID",
-                "time": "TIMESTAMP",
-                "datetime": "TIMESTAMP",
-                "date": "DATE",
-                "[]string": "TEXT[]",
-                "bytes": "BYTEA",
-                "bool": "BOOL",
-                "json": "JSON"
-
-                }
+class Database(Sink):
+    """postgres sink, every batch is written in its own transaction"""
 
     def __init__(self, config: ConfigV1, logger: logging.Logger):
-        self.config = config
+        super().__init__(config, logger)
         self.conn = None
         self.cur = None
-        self.schema: Schema = None
-        self.logger = logger
 
     def __enter__(self):
         self.conn = pg.connect(self.config.connection_string)
@@ -54,12 +36,15 @@ class Database:
             # self.type_converter(resource, data)
             # for d in data:
             #     self._datetime_conv(d)
+            if self.config.row_hash:
+                self._set_row_hashes(resource, data)
             # extract column names
             columns = list(data[0].keys())
             values_placeholder = ", ".join(f"%({col})s" for col in columns)
             stmt = f"INSERT INTO {resource} ({', '.join(columns)}) VALUES ({values_placeholder})"
 
             self.cur.executemany(stmt, data)
+            self._record_changes(resource, {"created": [x["id"] for x in data]})
             self.conn.commit()
         except Exception as e:
             self.logger.error(f"inserting into {resource}: with failed: {e}")
@@ -75,12 +60,25 @@ class Database:
             this is important to keep consistency on data corrections.
             Promotions that are corrected and therefore become part of the scope are not yet
             in the client's database. Therefore a standard update could lead to inconsistencies
+            :return: int: number of rows skipped because their row hash did not change
         """
+        skipped = 0
         try:
             # convert date times
             # self.type_converter(resource, data)
             # for d in data:
             #     self._datetime_conv(d)
+            id_key = self._id_key(resource)
+            stored = {}
+            if self.config.row_hash or self.config.change_feed:
+                stored = self._stored_hashes(resource, data)
+            if self.config.row_hash:
+                self._set_row_hashes(resource, data)
+                changed = [x for x in data if stored.get(id_key(x["id"])) != x["row_hash"]]
+                skipped = len(data) - len(changed)
+                data = changed
+                if len(data) == 0:
+                    return
             # extract column names
             columns = list(data[0].keys())
             values_placeholder = ", ".join(f"%({col})s" for col in columns)
@@ -91,6 +89,9 @@ class Database:
             """
 
             self.cur.executemany(stmt, data)
+            # ids that were not stored yet entered the scope with this batch
+            self._record_changes(resource, {"created": [x["id"] for x in data if id_key(x["id"]) not in stored],
+                                            "updated": [x["id"] for x in data if id_key(x["id"]) in stored]})
             self.conn.commit()
         except Exception as e:
             self.logger.error("UPSERT ERROR")
@@ -98,17 +99,19 @@ class Database:
             self.logger.error("UPSERT ERROR")
             # self.logger.error(data[0])
             self.conn.rollback()
+            skipped = 0
             # print(f"Error in PgRepo.insert for {resource_name} -> {e}")
             # raise
         finally:
-            return
+            return skipped
 
     def delete(self, resource, data: list[dict]):
         """delete data that is nor relevant"""
         try:
             ids = [x["id"] for x in data]
-            stmt = f"DELETE FROM {resource} WHERE id in %(ids)s"
-            self.cur.executemany(stmt, {"ids": tuple(ids)})
+            stmt = f"DELETE FROM {resource} WHERE id in %(ids)s RETURNING id"
+            self.cur.execute(stmt, {"ids": tuple(ids)})
+            self._record_changes(resource, {"deleted": [x[0] for x in self.cur.fetchall()]})
             self.conn.commit()
         except Exception as e:
             self.logger.error(f"deleting {resource}: with failed: {e}")
@@ -132,35 +135,6 @@ class Database:
             return None
         return response[0]
 
-    def type_converter(self, resource_name,  data: list[dict]):
-
-        tzinfo = None
-        col_types_dict = self.schema.lookup[resource_name]
-        for row in data:
-            for k, v in row.items():
-                if col_types_dict[k] == "time":
-                    if v is None:
-                        continue
-                    # v = v.replace("Z", "+00:00")
-                    v = v.replace("Z", "")
-                    dt = datetime.fromisoformat(v)
-                    row[k] = dt.replace(tzinfo=tzinfo)
-
-                elif col_types_dict[k] == "date":
-                    if v is None:
-                        continue
-                    # v = v.replace("Z", "+00:00")
-                    v = v.replace("Z", "")
-                    dt = datetime.fromisoformat(v).date()
-                    row[k] = dt
-                elif col_types_dict[k] == "datetime":
-                    if v is None:
-                        continue
-                    # v = v.replace("Z", "+00:00")
-                    v = v.replace("Z", "")
-                    dt = datetime.fromisoformat(v)
-                    row[k] = dt.replace(tzinfo=tzinfo)
-
     def create_tables(self, schema: Schema):
         try:
             for resource in schema.resources:
@@ -175,6 +149,15 @@ class Database:
                         stmt += "," + add
                 stmt += ");"
                 self.cur.execute(stmt)
+                if self.config.row_hash:
+                    # tables created before row hashing was enabled
+                    self.cur.execute(f"ALTER TABLE {resource.name} ADD COLUMN IF NOT EXISTS row_hash VARCHAR")
+                else:
+                    # hashes are not maintained while row hashing is disabled. stale ones would skip
+                    # valid updates once it is enabled again
+                    self.cur.execute(f"ALTER TABLE {resource.name} DROP COLUMN IF EXISTS row_hash")
+                if self.config.change_feed:
+                    self.cur.execute(self._outbox_table_def(resource))
                 self.conn.commit()
         except Exception as e:
             self.conn.rollback()
@@ -184,6 +167,74 @@ class Database:
         # use the schema
         return None
 
+    def _set_row_hashes(self, resource, data: list[dict]):
+        """
+        adds a content hash over the schema-defined attributes to every row.
+        attributes are hashed in schema order, so the hash does not depend on the key order of the payload
+        """
+        attributes = self._get_resource_by_name(resource).attributes
+        for row in data:
+            content = json.dumps([row.get(attr.name) for attr in attributes], default=str, separators=(",", ":"))
+            row["row_hash"] = hashlib.md5(content.encode("utf-8")).hexdigest()
+
+    def _stored_hashes(self, resource, data: list[dict]) -> dict:
+        """
+        returns the row hash of every id of data that is already stored, None if row hashing is disabled.
+        the keys are built with _id_key
+        """
+        ids = tuple(x["id"] for x in data)
+        hash_column = "row_hash" if self.config.row_hash else "NULL"
+        self.cur.execute(f"SELECT id, {hash_column} FROM {resource} WHERE id IN %(ids)s", {"ids": ids})
+        id_key = self._id_key(resource)
+        return {id_key(item_id): row_hash for item_id, row_hash in self.cur.fetchall()}
+
+    def _id_key(self, resource):
+        """
+        returns the function that maps ids of the resource to comparable keys.
+        postgres returns uuids in lowercase while the api may send them in uppercase
+        """
+        if self._get_id_type(self._get_resource_by_name(resource)) == "UUID":
+            return lambda item_id: str(item_id).lower()
+        return str
+
+    def _outbox_table_def(self, resource: Resource):
+        """
+        outbox table of a resource. every committed batch adds one row per operation holding the ids it touched,
+        so consumers can read increments instead of scanning the resource table
+        """
+        return f"""CREATE TABLE IF NOT EXISTS {resource.name}_outbox(
+                        seq BIGSERIAL PRIMARY KEY,
+                        operation VARCHAR NOT NULL,
+                        item_ids {self._get_id_type(resource)}[] NOT NULL,
+                        created_at TIMESTAMP NOT NULL DEFAULT NOW())
+        """
+
+    def _record_changes(self, resource, changes: dict[str, list]):
+        """
+        writes one outbox row per operation of the applied batch and queues a single NOTIFY on
+        <resource>_changes for the batch. must be called before commit: the outbox rows and the batch share the
+        transaction and postgres only delivers the notification once it is committed
+        :param changes: ids of the batch per operation (created, updated, deleted)
+        """
+        changes = {operation: ids for operation, ids in changes.items() if len(ids) > 0}
+        if not self.config.change_feed or len(changes) == 0:
+            return
+        id_type = self._get_id_type(self._get_resource_by_name(resource))
+        stmt = f"INSERT INTO {resource}_outbox (operation, item_ids) VALUES (%s, %s::{id_type}[]) RETURNING seq"
+        seq = None
+        for operation, ids in changes.items():
+            self.cur.execute(stmt, (operation, ids))
+            seq = self.cur.fetchone()[0]
+        payload = {"resource": resource, "seq": seq,
+                   "items": {operation: len(ids) for operation, ids in changes.items()}}
+        self.cur.execute("SELECT pg_notify(%s, %s)", (f"{resource}_changes", json.dumps(payload)))
+
+    def _get_id_type(self, resource: Resource):
+        for attr in resource.attributes:
+            if attr.name == "id":
+                return self.type_map[attr.type.lower()]
+        return "VARCHAR"
+
     def _get_type_def(self, attr: Attribute):
         db_type = self.type_map[attr.type.lower()]
         if attr.primary_key is True:
@@ -201,8 +252,4 @@ class Database:
 
         return db_type
 
-    def _get_resource_by_name(self, name):
-        for r in self.schema.resources:
-            if r.name == name:
-                return r
 
@@ -0,0 +1,124 @@
+"""
+Interface every client data store implements, so the sync flow does not depend on a specific database
+"""
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime
+from utils import Schema
+from config import ConfigV1
+
+
+class Sink(ABC):
+    """
+    client side data store the resources are synchronised into.
+    implementations are used as context manager and receive the decoded lines in batches.
+
+    insert, upsert and delete never raise: a batch that cannot be written is logged and dropped,
+    like the rollback of a failed postgres transaction, so the remaining batches are still synchronised.
+    """
+    # postgres types of the api types, other sinks override the entries that differ
+    type_map = {"int64": "BIGINT",
+                "int16": "INT",
+                "int32": "INT",
+                "database.nullint16": "INT",
+                "int": "INT",
+                "string": "VARCHAR",
+                "float64": "REAL",
+                "float32": "REAL",
+                "uuid": "UUID",
+                "time": "TIMESTAMP",
+                "datetime": "TIMESTAMP",
+                "date": "DATE",
+                "[]string": "TEXT[]",
+                "bytes": "BYTEA",
+                "bool": "BOOL",
+                "json": "JSON"
+
+                }
+
+    def __init__(self, config: ConfigV1, logger: logging.Logger):
+        self.config = config
+        self.schema: Schema = None
+        self.logger = logger
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return None
+
+    @abstractmethod
+    def create_tables(self, schema: Schema):
+        """creates the storage for every resource of the schema if it does not exist (idempotent)"""
+
+    @abstractmethod
+    def insert(self, resource, data: list[dict]):
+        """insert new data, a failing batch is logged and dropped"""
+
+    @abstractmethod
+    def upsert(self, resource, data: list[dict]) -> int:
+        """
+        insert or update data, a failing batch is logged and dropped
+        :return: int: number of rows skipped because they did not change
+        """
+
+    @abstractmethod
+    def delete(self, resource, data: list[dict]):
+        """delete the items with the ids in data, a failing batch is logged and dropped"""
+
+    @abstractmethod
+    def latest_state(self, resource):
+        """returns the latest created_at or updated_at of the resource, None if it is empty"""
+
+    @abstractmethod
+    def total_client_items(self, resource):
+        """returns the number of items of the resource"""
+
+    def type_converter(self, resource_name,  data: list[dict]):
+
+        tzinfo = None
+        col_types_dict = self.schema.lookup[resource_name]
+        for row in data:
+            for k, v in row.items():
+                if col_types_dict.get(k) == "time":
+                    if v is None:
+                        continue
+                    # v = v.replace("Z", "+00:00")
+                    v = v.replace("Z", "")
+                    dt = datetime.fromisoformat(v)
+                    row[k] = dt.replace(tzinfo=tzinfo)
+
+                elif col_types_dict.get(k) == "date":
+                    if v is None:
+                        continue
+                    # v = v.replace("Z", "+00:00")
+                    v = v.replace("Z", "")
+                    dt = datetime.fromisoformat(v).date()
+                    row[k] = dt
+                elif col_types_dict.get(k) == "datetime":
+                    if v is None:
+                        continue
+                    # v = v.replace("Z", "+00:00")
+                    v = v.replace("Z", "")
+                    dt = datetime.fromisoformat(v)
+                    row[k] = dt.replace(tzinfo=tzinfo)
+
+    def _get_resource_by_name(self, name):
+        for r in self.schema.resources:
+            if r.name == name:
+                return r
+
+
+def create_sink(config: ConfigV1, logger: logging.Logger) -> Sink:
+    """returns the sink configured by db_type in config.yml"""
+    db_type = config.db_type.lower()
+    if db_type in ("postgres", "postgresql"):
+        from utils.db import Database
+        return Database(config, logger)
+    if db_type == "duckdb":
+        from utils.columnar import DuckDbSink
+        return DuckDbSink(config, logger)
+    if db_type == "parquet":
+        from utils.columnar import ParquetSink
+        return ParquetSink(config, logger)
+    raise ValueError(f"unsupported db_type {config.db_type}")